@@ -4,14 +4,14 @@ Basic asyncio.Protocol interface for IRC connections
 """
 import asyncio
 import base64
-import random
+import logging
 import socket
 import time
 from asyncio import Protocol
 from collections import defaultdict
 from enum import IntEnum, auto, unique
 from itertools import cycle
-from typing import Sequence, Optional, Tuple, Callable, Dict, Coroutine, AnyStr, TYPE_CHECKING, Any
+from typing import Sequence, Optional, Tuple, Callable, Dict, Coroutine, AnyStr, TYPE_CHECKING, Any, List
 
 from irclib.parser import Message, CapList, Cap
 
@@ -21,11 +21,36 @@ from asyncirc.util.backoff import AsyncDelayer
 if TYPE_CHECKING:
     from logging import Logger
     from asyncirc.server import Server, BaseServer
-    from asyncio import AbstractEventLoop, Transport
+    from asyncio import AbstractEventLoop, Future, Transport
 
 
 __all__ = ('SASLMechanism', 'IrcProtocol')
 
+CRLF = b'\r\n'
+
+# Shared empty mapping for handler lookups that miss, never mutated
+_EMPTY: Dict[int, Tuple[Callable, bool]] = {}
+
+
+def _parse_command(raw_line: bytes) -> str:
+    """Extract only the command from a raw line, skipping any tags and prefix"""
+    start = 0
+    if raw_line.startswith(b'@'):
+        start = raw_line.find(b' ') + 1
+        if not start:
+            return ''
+
+    if raw_line.startswith(b':', start):
+        start = raw_line.find(b' ', start) + 1
+        if not start:
+            return ''
+
+    end = raw_line.find(b' ', start)
+    if end < 0:
+        end = len(raw_line)
+
+    return raw_line[start:end].decode(errors='ignore').upper()
+
 
 @unique
 class SASLMechanism(IntEnum):
@@ -35,8 +60,17 @@ class SASLMechanism(IntEnum):
     EXTERNAL = auto()
 
 
-async def _internal_ping(conn: 'IrcProtocol', message: 'Message'):
-    conn.send("PONG {}".format(message.parameters))
+def _internal_ping(conn: 'IrcProtocol', message: 'Message'):
+    conn._send_bytes("PONG {}".format(message.parameters).encode())
+
+
+async def _run_handlers(handlers: List[Callable[..., Coroutine]], *args: Any) -> None:
+    # Awaiting one or two handlers in turn is cheaper than gathering them as separate tasks
+    if len(handlers) <= 2:
+        for func in handlers:
+            await func(*args)
+    else:
+        await asyncio.gather(*[func(*args) for func in handlers])
 
 
 async def _internal_cap_handler(conn: 'IrcProtocol', message: 'Message'):
@@ -52,23 +86,25 @@ async def _internal_cap_handler(conn: 'IrcProtocol', message: 'Message'):
         if message.parameters[2] != '*':
             for cap in conn.server.caps:
                 conn.send("CAP REQ :{}".format(cap))
+            conn.server.pending_caps = sum(1 for val in conn.server.caps.values() if val[1] is None)
             if not conn.server.caps:
-                conn.send("CAP END")  # We haven't request any CAPs, send a CAP END to end negotiation
+                conn._send_bytes(b"CAP END")  # We haven't request any CAPs, send a CAP END to end negotiation
 
     elif message.parameters[1] in ('ACK', 'NAK'):
         enabled = message.parameters[1] == 'ACK'
         for cap in caplist:
-            current = conn.server.caps[cap.name][0]
+            current, was_enabled = conn.server.caps[cap.name]
             conn.server.caps[cap.name] = (current, enabled)
+            if was_enabled is None:
+                conn.server.pending_caps -= 1
             if enabled:
-                handlers = filter(None, conn.cap_handlers[cap.name])
-                await asyncio.gather(*[func(conn, cap) for func in handlers])
+                await _run_handlers([func for func in conn.cap_handlers[cap.name] if func], conn, cap)
 
-        if all(val[1] is not None for val in conn.server.caps.values()):
+        if conn.server.pending_caps <= 0:
             # If SASL is enabled, SASL negotiation should be complete before sending CAP END,
             # so this is done in the SASL handler.
             if conn.sasl_mech == SASLMechanism.NONE:
-                conn.send("CAP END")
+                conn._send_bytes(b"CAP END")
 
     elif message.parameters[1] == 'LIST':
         if conn.logger:
@@ -83,12 +119,15 @@ async def _internal_cap_handler(conn: 'IrcProtocol', message: 'Message'):
         if message.parameters[2] != '*':
             for cap in conn.server.caps:
                 conn.send("CAP REQ :{}".format(cap))
+            conn.server.pending_caps = sum(1 for val in conn.server.caps.values() if val[1] is None)
     elif message.parameters[1] == 'DEL':
         if conn.logger:
             conn.logger.info("Capabilities removed: %s", caplist)
         for cap in caplist:
-            current = conn.server.caps[cap.name][0]
+            current, was_enabled = conn.server.caps[cap.name]
             conn.server.caps[cap.name] = (current, False)
+            if was_enabled is None:
+                conn.server.pending_caps -= 1
 
 
 async def _internal_pong(conn: 'IrcProtocol', msg: 'Message'):
@@ -125,14 +164,14 @@ async def _do_sasl(conn: 'IrcProtocol', cap):
     # Send CAP END here, because it shouldn't be sent before SASL auth is complete
     # NOTE: there is a (probably unlikely) race condition here, if CAP negotiation is
     # incomplete by this point.
-    conn.send("CAP END")
+    conn._send_bytes(b"CAP END")
 
 
 async def _isupport_handler(conn: 'IrcProtocol', message: 'Message'):
     tokens = message.parameters[1:-1]  # Remove the nick and trailing ':are supported by this server' message
     for token in tokens:
-        if token[0] == '-' and token.upper() in conn.server.isupport_tokens:
-            del conn.server.isupport_tokens[token.upper()]
+        if token[:1] == '-':
+            conn.server.isupport_tokens.pop(token[1:].upper(), None)
         else:
             name, _, value = token.partition('=')
             conn.server.isupport_tokens[name.upper()] = value or None
@@ -146,7 +185,6 @@ class IrcProtocol(Protocol):
     """Async IRC Interface"""
 
     _transport: Optional['Transport'] = None
-    _buff = b""
     _server: Optional['ConnectedServer'] = None
     _connected = False
     _quitting = False
@@ -163,17 +201,24 @@ class IrcProtocol(Protocol):
         self.sasl_mech = SASLMechanism(sasl_mech or SASLMechanism.NONE)
         self.logger = logger
         self.loop = loop or asyncio.get_event_loop()
+        self._create_task = self.loop.create_task
+        self._buff = bytearray()
+        self._pending_out = bytearray()
+        self._flush_scheduled = False
 
         if self.sasl_mech == SASLMechanism.PLAIN:
             assert self.sasl_auth, "You must specify sasl_auth when using SASL PLAIN"
 
         self.handlers: Dict[int, Tuple[str, Callable]] = {}
+        self._next_hook_id = 0
+        self._by_cmd: Dict[str, Dict[int, Tuple[Callable, bool]]] = defaultdict(dict)
+        self._waiters: Dict[str, List['Future']] = defaultdict(list)
         self.cap_handlers = defaultdict(list)
 
         self._connected_future = self.loop.create_future()
         self.quit_future = self.loop.create_future()
 
-        self.register("PING", _internal_ping)
+        self.register("PING", _internal_ping, sync=True)
         self.register("PONG", _internal_pong)
         self.register("CAP", _internal_cap_handler)
         self.register('001', _on_001)
@@ -223,8 +268,11 @@ class IrcProtocol(Protocol):
                     break
 
     async def _connect(self, server: 'BaseServer') -> bool:
-        self._connected_future = self.loop.create_future()
-        self.quit_future = self.loop.create_future()
+        # Reuse any pending futures so sends already waiting on the connection aren't orphaned
+        if self._connected_future.done():
+            self._connected_future = self.loop.create_future()
+        if self.quit_future.done():
+            self.quit_future = self.loop.create_future()
         self._server = ConnectedServer(server)
         if self.logger:
             if self.connected:
@@ -245,17 +293,28 @@ class IrcProtocol(Protocol):
             return False
         return True
 
-    def register(self, cmd: str, handler: Callable[['IrcProtocol', 'Message'], Coroutine]) -> int:
-        """Register a command handler"""
-        hook_id = 0
-        while not hook_id or hook_id in self.handlers:
-            hook_id = random.randint(1, (2 ** 32) - 1)
+    def register(self, cmd: str, handler: Callable[['IrcProtocol', 'Message'], Optional[Coroutine]],
+                 sync: bool = False) -> int:
+        """Register a command handler
+
+        If sync is True, the handler is a plain function and is called directly from data_received
+        rather than being scheduled as a task. It runs inline while the read buffer is being parsed,
+        so it must not block. It may register or unregister hooks, and any exception it raises is
+        logged rather than interrupting the processing of further lines
+        """
+        self._next_hook_id += 1
+        hook_id = self._next_hook_id
         self.handlers[hook_id] = (cmd, handler)
+        self._by_cmd[cmd][hook_id] = (handler, sync)
         return hook_id
 
     def unregister(self, hook_id: int) -> None:
         """Unregister a hook"""
-        del self.handlers[hook_id]
+        cmd, _ = self.handlers.pop(hook_id)
+        hooks = self._by_cmd[cmd]
+        del hooks[hook_id]
+        if not hooks:
+            del self._by_cmd[cmd]
 
     def register_cap(self, cap: str, handler: Optional[Callable[['IrcProtocol', 'Cap'], Coroutine]] = None) -> None:
         """Register a CAP handler
@@ -270,41 +329,63 @@ class IrcProtocol(Protocol):
         if not cmds:
             return
         fut = self.loop.create_future()
-
-        # noinspection PyUnusedLocal
-        async def _wait(conn: 'IrcProtocol', message: 'Message') -> None:
-            if not fut.done():
-                fut.set_result(message)
-
-        hooks = [
-            self.register(cmd, _wait) for cmd in cmds
-        ]
+        for cmd in cmds:
+            self._waiters[cmd].append(fut)
 
         try:
             result = await asyncio.wait_for(fut, timeout)
         except asyncio.TimeoutError:
             result = None
         finally:
-            for hook_id in hooks:
-                self.unregister(hook_id)
+            for cmd in cmds:
+                waiters = self._waiters.get(cmd)
+                if waiters and fut in waiters:
+                    waiters.remove(fut)
+                    if not waiters:
+                        del self._waiters[cmd]
         return result
 
     def send(self, text: AnyStr) -> None:
         """Send a raw line to the server"""
-        asyncio.run_coroutine_threadsafe(self._send(text), self.loop)
+        if isinstance(text, str):
+            text = text.encode()
+        self._send_bytes(text)
+
+    def _send_bytes(self, data: bytes) -> None:
+        # Transports aren't thread-safe, so only write directly when called from the event loop's thread.
+        # asyncio._get_running_loop() is used instead of get_running_loop() as the latter was only
+        # added in Python 3.7, and we still support 3.6
+        if asyncio._get_running_loop() is not self.loop:
+            asyncio.run_coroutine_threadsafe(self._send(data), self.loop)
+        elif self._connected:
+            self._write(data)
+        else:
+            self._create_task(self._send(data))
 
     def send_command(self, msg: Message) -> None:
         """Send an irclib Message object to the server"""
         return self.send(str(msg))
 
-    async def _send(self, text: AnyStr) -> None:
+    async def _send(self, data: bytes) -> None:
         if not self.connected:
             await self._connected_future
-        if isinstance(text, str):
-            text = text.encode()
-        if self.logger:
-            self.logger.info(">> %s", text.decode())
-        self._transport.write(text + b'\r\n')
+        self._write(data)
+
+    def _write(self, data: bytes) -> None:
+        if self.logger and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(">> %s", data.decode())
+        self._pending_out.extend(data)
+        self._pending_out.extend(CRLF)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush_out)
+
+    def _flush_out(self) -> None:
+        """Write all lines queued during this loop iteration in a single call"""
+        self._flush_scheduled = False
+        data, self._pending_out = self._pending_out, bytearray()
+        if data and self._transport is not None:
+            self._transport.write(data)
 
     def quit(self, reason: str = None) -> None:
         """Quit the IRC connection with an optional reason"""
@@ -313,15 +394,14 @@ class IrcProtocol(Protocol):
             if reason:
                 self.send("QUIT {}".format(reason))
             else:
-                self.send("QUIT")
+                self._send_bytes(b"QUIT")
 
     def connection_made(self, transport: 'Transport') -> None:
         """Called by the event loop when the connection has been established"""
         self._transport = transport
         self._connected = True
         self._connected_future.set_result(None)
-        del self._connected_future
-        self.send("CAP LS 302")
+        self._send_bytes(b"CAP LS 302")
         if self.server.password:
             self.send("PASS {}".format(self.server.password))
         self.send("NICK {}".format(self.nick))
@@ -331,6 +411,8 @@ class IrcProtocol(Protocol):
         """Connection to the IRC server has been lost"""
         self._transport = None
         self._connected = False
+        # Don't carry lines meant for the old connection over to the next one
+        self._pending_out.clear()
         if not self._quitting:
             self._connected_future = self.loop.create_future()
             asyncio.run_coroutine_threadsafe(self.connect(), self.loop)
@@ -339,13 +421,68 @@ class IrcProtocol(Protocol):
 
     def data_received(self, data: bytes) -> None:
         """Called by the event loop when data has been read from the socket"""
-        self._buff += data
-        while b'\r\n' in self._buff:
-            raw_line, self._buff = self._buff.split(b'\r\n', 1)
-            message = Message.parse(raw_line)
-            for trigger, func in self.handlers.values():
-                if trigger in (message.command, '*'):
-                    self.loop.create_task(func(self, message))
+        buff = self._buff
+        buff.extend(data)
+        start = 0
+        try:
+            while True:
+                end = buff.find(CRLF, start)
+                if end < 0:
+                    break
+
+                raw_line = bytes(buff[start:end])
+                start = end + 2
+                self._handle_line(raw_line)
+        finally:
+            del buff[:start]
+
+    def _handle_line(self, raw_line: bytes) -> None:
+        if '*' not in self._by_cmd and '*' not in self._waiters:
+            cmd = _parse_command(raw_line)
+            if cmd not in self._by_cmd and cmd not in self._waiters:
+                # Nothing is listening for this command, so skip parsing the rest of the line
+                return
+
+        message = Message.parse(raw_line)
+        cmd = message.command
+        if self._waiters:
+            self._wake_waiters(cmd, message)
+            self._wake_waiters('*', message)
+
+        # Iterate over a snapshot, as sync handlers may register or unregister hooks while being called
+        for func, sync in tuple(self._by_cmd.get(cmd, _EMPTY).values()):
+            if sync:
+                self._call_sync(func, message)
+            else:
+                self._create_task(func(self, message))
+
+        for func, sync in tuple(self._by_cmd.get('*', _EMPTY).values()):
+            if sync:
+                self._call_sync(func, message)
+            else:
+                self._create_task(func(self, message))
+
+    def _call_sync(self, func: Callable, message: 'Message') -> None:
+        # Exceptions escaping data_received would make the transport drop the connection,
+        # so report them the same way an exception in a handler task would be
+        try:
+            func(self, message)
+        except Exception as e:
+            if self.logger:
+                self.logger.exception("Error in handler %r for %s", func, message.command)
+            else:
+                self.loop.call_exception_handler({
+                    'message': "Error in handler {!r} for {}".format(func, message.command),
+                    'exception': e,
+                    'protocol': self,
+                })
+
+    def _wake_waiters(self, cmd: str, message: 'Message') -> None:
+        waiters = self._waiters.pop(cmd, None)
+        if waiters:
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(message)
 
     @property
     def user(self) -> str:
@@ -151,6 +151,8 @@ class ConnectedServer:
         self.password = server.password
         self.isupport_tokens: Dict[str, str] = {}
         self.caps: Dict[str, Tuple[Cap, Optional[bool]]] = {}
+        # Number of requested CAPs still waiting on an ACK or NAK
+        self.pending_caps = 0
         self.server_name = None
         self.data = {}
 
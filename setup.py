@@ -17,6 +17,9 @@ setup(
     keywords='asyncio irc asyncirc async-irc irc-framework',
     packages=['asyncirc', 'asyncirc.util'],
     install_requires=['py-irclib'],
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
 )
@@ -0,0 +1,308 @@
+import asyncio
+
+import pytest
+from irclib.parser import Message
+
+from asyncirc.protocol import IrcProtocol, _isupport_handler, _parse_command
+from asyncirc.server import BaseServer, ConnectedServer, Server
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    # asyncio.all_tasks() only exists from Python 3.7
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    for task in all_tasks(loop):
+        task.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def _run_pending(loop):
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_dispatch(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    seen = []
+
+    async def on_privmsg(conn, message):
+        seen.append(('PRIVMSG', message.command))
+
+    async def on_any(conn, message):
+        seen.append(('*', message.command))
+
+    proto.register('PRIVMSG', on_privmsg)
+    proto.register('*', on_any)
+
+    proto.data_received(b':a!b@c PRIVMSG #chan :hello\r\n:a!b@c NOTICE #chan :hi\r\n')
+    _run_pending(loop)
+
+    assert sorted(seen) == [('*', 'NOTICE'), ('*', 'PRIVMSG'), ('PRIVMSG', 'PRIVMSG')]
+
+
+def test_unregister(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    seen = []
+
+    async def on_privmsg(conn, message):
+        seen.append(message)
+
+    hook_id = proto.register('PRIVMSG', on_privmsg)
+    proto.unregister(hook_id)
+
+    assert hook_id not in proto.handlers
+    assert 'PRIVMSG' not in proto._by_cmd
+
+    proto.data_received(b':a!b@c PRIVMSG #chan :hello\r\n')
+    _run_pending(loop)
+
+    assert not seen
+
+
+def test_wait_for(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+
+    async def _wait():
+        task = loop.create_task(proto.wait_for('903', '904', timeout=5))
+        await asyncio.sleep(0)
+        proto.data_received(b':server 904 nick :SASL authentication failed\r\n')
+        return await task
+
+    message = loop.run_until_complete(_wait())
+
+    assert message.command == '904'
+    assert not proto._waiters
+
+
+def test_wait_for_timeout(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+
+    assert loop.run_until_complete(proto.wait_for('903', timeout=0)) is None
+    assert not proto._waiters
+
+
+def test_sync_handler(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    seen = []
+
+    def on_privmsg(conn, message):
+        seen.append(message.command)
+
+    proto.register('PRIVMSG', on_privmsg, sync=True)
+    proto.data_received(b':a!b@c PRIVMSG #chan :hello\r\n')
+
+    assert seen == ['PRIVMSG']
+
+
+def test_sync_handler_unregisters_itself(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    seen = []
+
+    def on_privmsg(conn, message):
+        seen.append(message.parameters[-1])
+        conn.unregister(hook_id)
+        conn.register('PRIVMSG', on_privmsg_2, sync=True)
+
+    def on_privmsg_2(conn, message):
+        seen.append(message.parameters[-1] + '-2')
+
+    hook_id = proto.register('PRIVMSG', on_privmsg, sync=True)
+    proto.data_received(b':a!b@c PRIVMSG #chan :one\r\n:a!b@c PRIVMSG #chan :two\r\n')
+
+    assert seen == ['one', 'two-2']
+    assert not proto._buff
+
+
+def test_sync_handler_error(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    seen = []
+    errors = []
+
+    def on_privmsg(conn, message):
+        if message.parameters[-1] == 'one':
+            raise ValueError(message.parameters[-1])
+        seen.append(message.parameters[-1])
+
+    loop.set_exception_handler(lambda _loop, context: errors.append(context['exception']))
+    proto.register('PRIVMSG', on_privmsg, sync=True)
+    proto.data_received(b':a!b@c PRIVMSG #chan :one\r\n:a!b@c PRIVMSG #chan :two\r\n')
+
+    assert seen == ['two']
+    assert [str(e) for e in errors] == ['one']
+    assert not proto._buff
+
+
+class _Transport:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+
+def test_send(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    proto._server = ConnectedServer(Server('irc.example.org', 6667))
+    transport = _Transport()
+
+    async def _connect():
+        proto.connection_made(transport)
+
+    async def _send():
+        proto.send("PRIVMSG #chan :hello")
+
+    loop.run_until_complete(_connect())
+    _run_pending(loop)
+    del transport.data[:]
+
+    loop.run_until_complete(_send())
+    _run_pending(loop)
+
+    assert transport.data == b'PRIVMSG #chan :hello\r\n'
+
+
+def test_send_batched(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    proto._server = ConnectedServer(Server('irc.example.org', 6667))
+    writes = []
+    transport = _Transport()
+    transport.write = writes.append
+
+    async def _connect():
+        proto.connection_made(transport)
+
+    loop.run_until_complete(_connect())
+    _run_pending(loop)
+
+    assert writes == [b'CAP LS 302\r\nNICK nick\r\nUSER nick 0 * :nick\r\n']
+
+
+@pytest.mark.parametrize('line', [
+    b'PING :server',
+    b'ping server',
+    b':nick!user@host PRIVMSG #chan :hello',
+    b'@time=2020-01-01T00:00:00.000Z :nick!user@host PRIVMSG #chan :hello',
+    b'@time=2020-01-01T00:00:00.000Z NOTICE * :hello',
+    b'001',
+    b':server',
+    b'@tag',
+    b'',
+])
+def test_parse_command(line):
+    assert _parse_command(line) == Message.parse(line).command
+
+
+def test_unhandled_line_not_parsed(loop, monkeypatch):
+    proto = IrcProtocol([], 'nick', loop=loop)
+
+    def _parse(line):
+        raise AssertionError("Line should not be parsed")
+
+    monkeypatch.setattr(Message, 'parse', _parse)
+    proto.data_received(b':a!b@c PRIVMSG #chan :hello\r\n')
+
+
+def test_cap_negotiation(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    proto._server = ConnectedServer(Server('irc.example.org', 6667))
+    proto.register_cap('userhost-in-names')
+    proto.register_cap('multi-prefix')
+    transport = _Transport()
+
+    async def _negotiate():
+        proto.connection_made(transport)
+        await asyncio.sleep(0)
+        del transport.data[:]
+
+        proto.data_received(b':server CAP * LS :multi-prefix sasl userhost-in-names\r\n')
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert proto.server.pending_caps == 3
+
+        proto.data_received(b':server CAP nick ACK :multi-prefix userhost-in-names\r\n')
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert b'CAP END' not in transport.data
+
+        proto.data_received(b':server CAP nick NAK :sasl\r\n')
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(_negotiate())
+
+    assert proto.server.pending_caps == 0
+    assert transport.data.endswith(b'CAP END\r\n')
+
+
+def test_isupport(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    proto._server = ConnectedServer(Server('irc.example.org', 6667))
+
+    async def _isupport():
+        await _isupport_handler(proto, Message.parse(
+            ':server 005 nick network=Example EXCEPTS INVEX=I :are supported by this server'
+        ))
+        await _isupport_handler(proto, Message.parse(
+            ':server 005 nick -INVEX :are supported by this server'
+        ))
+
+    loop.run_until_complete(_isupport())
+
+    assert proto.server.isupport_tokens == {'NETWORK': 'Example', 'EXCEPTS': None}
+
+
+def test_data_received_fragmented(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    seen = []
+
+    def on_privmsg(conn, message):
+        seen.append(message.parameters[-1])
+
+    proto.register('PRIVMSG', on_privmsg, sync=True)
+
+    proto.data_received(b':a!b@c PRIVMSG #chan :one\r\n:a!b@c PRIV')
+    assert seen == ['one']
+    assert proto._buff == b':a!b@c PRIV'
+
+    proto.data_received(b'MSG #chan :two\r')
+    assert seen == ['one']
+
+    proto.data_received(b'\n:a!b@c PRIVMSG #chan :three\r\n:a!b@c PRIVMSG #chan :four\r\n')
+    assert seen == ['one', 'two', 'three', 'four']
+    assert not proto._buff
+
+
+def test_send_before_connect(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    proto._server = ConnectedServer(Server('irc.example.org', 6667))
+    transport = _Transport()
+
+    async def _send():
+        proto.send("JOIN #chan")
+        await asyncio.sleep(0)
+        proto.connection_made(transport)
+
+    loop.run_until_complete(_send())
+    _run_pending(loop)
+
+    assert transport.data.endswith(b'JOIN #chan\r\n')
+
+
+def test_connect_reuses_pending_futures(loop):
+    proto = IrcProtocol([], 'nick', loop=loop)
+    connected_future = proto._connected_future
+    quit_future = proto.quit_future
+
+    class _Server(BaseServer):
+        async def connect(self, protocol_factory, *, loop=None, **kwargs):
+            pass
+
+        def __str__(self):
+            return 'test'
+
+    assert loop.run_until_complete(proto._connect(_Server()))
+
+    assert proto._connected_future is connected_future
+    assert proto.quit_future is quit_future